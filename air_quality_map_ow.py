@@ -1,50 +1,125 @@
+import asyncio
+import os
+import random
+
+import httpx
+import orjson
 import geopandas as gpd
 import folium
-import requests
 import numpy as np
 from shapely.geometry import Point
-from sklearn.neighbors import BallTree
 import streamlit as st
+import streamlit.components.v1 as components
 from streamlit_folium import st_folium
 import branca.colormap as cm
+from collections import namedtuple
 from datetime import datetime, timedelta
 from geopy.geocoders import Nominatim
 
 # CONFIG
 st.set_page_config(page_title="Chicago AQI Map", layout="wide")
 SHAPEFILE_PATH = "neighborhoods_shapefile.shp"
-API_KEY = "48b8cf776845b1b3b76e183c60826568"
+API_KEY = st.secrets.get("OPENWEATHER_KEY", os.environ.get("OPENWEATHER_KEY", ""))
+
+# Load shapefile; only the name and geometry are ever used, so drop the
+# rest of the shapefile attributes up front and hand centroids back as
+# plain arrays instead of a second geometry column
+Neighborhoods = namedtuple("Neighborhoods", ["gdf", "cx", "cy"])
 
-# Load shapefile
 @st.cache_resource
 def load_neighborhoods():
-    gdf = gpd.read_file(SHAPEFILE_PATH).rename(columns={'neighborho': 'neighborhood'})
+    gdf = gpd.read_file(SHAPEFILE_PATH)[["neighborho", "geometry"]].rename(columns={'neighborho': 'neighborhood'})
     gdf["neighborhood"] = gdf["neighborhood"].str.strip().str.title()
-    gdf["centroid"] = gdf.centroid
-    return gdf
+    gdf = gdf.to_crs(4326)
+    # ~55 m tolerance: invisible at zoom 11 but shrinks the GeoJSON payload a lot
+    gdf["geometry"] = gdf.geometry.simplify(0.0005, preserve_topology=True)
+    centroids = gdf.centroid
+    return Neighborhoods(gdf, centroids.x.to_numpy(), centroids.y.to_numpy())
 
-# Fetch OpenWeather API data
-@st.cache_data(ttl=900)
-def fetch_aqi(lat, lon, mode="current", start=None, end=None):
+# Build OpenWeather API url
+def build_aqi_url(lat, lon, mode="current", start=None, end=None):
     if mode == "forecast":
-        url = f"http://api.openweathermap.org/data/2.5/air_pollution/forecast?lat={lat}&lon={lon}&appid={API_KEY}"
+        return f"https://api.openweathermap.org/data/2.5/air_pollution/forecast?lat={lat}&lon={lon}&appid={API_KEY}"
     elif mode == "historic" and start and end:
-        url = f"http://api.openweathermap.org/data/2.5/air_pollution/history?lat={lat}&lon={lon}&start={start}&end={end}&appid={API_KEY}"
-    else:
-        url = f"http://api.openweathermap.org/data/2.5/air_pollution?lat={lat}&lon={lon}&appid={API_KEY}"
-    r = requests.get(url)
-    if r.status_code == 200:
-        return r.json().get("list", [])
+        return f"https://api.openweathermap.org/data/2.5/air_pollution/history?lat={lat}&lon={lon}&start={start}&end={end}&appid={API_KEY}"
+    return f"https://api.openweathermap.org/data/2.5/air_pollution?lat={lat}&lon={lon}&appid={API_KEY}"
+
+# Fetch all neighborhoods concurrently; HTTP/2 multiplexes the whole
+# batch over a couple of connections instead of one socket per request.
+# 429/5xx and transport errors are retried with exponential backoff +
+# jitter so a transient hiccup doesn't leave holes across the map; other
+# 4xx responses won't get better on retry so give up immediately.
+_MAX_ATTEMPTS = 4
+
+async def fetch_one(client, url, sem):
+    delay = 0.5
+    for attempt in range(_MAX_ATTEMPTS):
+        try:
+            async with sem:
+                r = await client.get(url)
+        except httpx.TransportError:
+            r = None
+        if r is not None:
+            if r.status_code == 200:
+                return orjson.loads(r.content).get("list", [])
+            if r.status_code == 429:
+                retry_after = r.headers.get("Retry-After")
+                if retry_after and retry_after.isdigit():
+                    delay = max(delay, float(retry_after))
+            elif r.status_code < 500:
+                return []
+        if attempt < _MAX_ATTEMPTS - 1:
+            await asyncio.sleep(min(delay, 8) * (1 + random.random()))
+            delay *= 2
     return []
 
-# Pollutant key conversion
-def pollutant_key_map(p):
-    return {"pm25": "pm2_5", "pm10": "pm10", "o3": "o3", "no2": "no2", "so2": "so2", "co": "co"}.get(p.lower(), p)
+async def fetch_all(urls):
+    limits = httpx.Limits(max_connections=50, max_keepalive_connections=50)
+    # Keep the burst under OpenWeather's per-second rate limit
+    sem = asyncio.Semaphore(20)
+    async with httpx.AsyncClient(http2=True, limits=limits) as client:
+        return await asyncio.gather(*[fetch_one(client, url, sem) for url in urls])
 
-# BallTree for future expansion
-@st.cache_resource
-def build_ball_tree(coords):
-    return BallTree(np.radians(coords), metric='haversine')
+def _fetch_all_aqi(mode, start_unix, end_unix, coords_tuple):
+    urls = [build_aqi_url(lat, lon, mode, start_unix, end_unix) for lat, lon in coords_tuple]
+    return asyncio.run(fetch_all(urls))
+
+# One cache entry for the whole result set, so a rerun costs a single
+# lookup instead of one hash + copy per neighborhood. TTL depends on how
+# fast the data goes stale: current updates every ~10 min, forecast hourly,
+# and a historic window that already ended never changes at all (persisted
+# to disk so those survive app restarts).
+@st.cache_data(ttl=600, max_entries=128)
+def _load_current_aqi(start_unix, end_unix, coords_tuple):
+    return _fetch_all_aqi("current", start_unix, end_unix, coords_tuple)
+
+@st.cache_data(ttl=3600, max_entries=128)
+def _load_forecast_aqi(start_unix, end_unix, coords_tuple):
+    return _fetch_all_aqi("forecast", start_unix, end_unix, coords_tuple)
+
+@st.cache_data(ttl=86400 * 30, max_entries=128, persist="disk")
+def _load_closed_historic_aqi(start_unix, end_unix, coords_tuple):
+    return _fetch_all_aqi("historic", start_unix, end_unix, coords_tuple)
+
+@st.cache_data(ttl=1800, max_entries=128)
+def _load_open_historic_aqi(start_unix, end_unix, coords_tuple):
+    return _fetch_all_aqi("historic", start_unix, end_unix, coords_tuple)
+
+def load_all_aqi(mode, start_unix, end_unix, coords_tuple):
+    if mode == "forecast":
+        return _load_forecast_aqi(start_unix, end_unix, coords_tuple)
+    if mode == "historic":
+        today_unix = int(datetime.combine(datetime.today(), datetime.min.time()).timestamp())
+        if end_unix and end_unix < today_unix:
+            return _load_closed_historic_aqi(start_unix, end_unix, coords_tuple)
+        return _load_open_historic_aqi(start_unix, end_unix, coords_tuple)
+    return _load_current_aqi(start_unix, end_unix, coords_tuple)
+
+# Pollutant key conversion (UI name -> OpenWeather component key)
+_POLL_KEY = {"pm25": "pm2_5", "pm10": "pm10", "o3": "o3", "no2": "no2", "so2": "so2", "co": "co"}
+
+def pollutant_key_map(p):
+    return _POLL_KEY.get(p, p)
 
 # UI HEADER
 st.markdown("<h1 style='text-align: center;'>Air Quality Map of Chicago</h1>", unsafe_allow_html=True)
@@ -56,9 +131,9 @@ selected_pollutants = st.multiselect("Select Pollutants", pollutants, default=["
 color_by = st.selectbox("Color Map By", selected_pollutants)
 
 # LOAD SHAPEFILE
-neighborhoods = load_neighborhoods()
-coords = np.array([[pt.y, pt.x] for pt in neighborhoods["centroid"]])
-tree = build_ball_tree(coords)
+neighborhoods, cx, cy = load_neighborhoods()
+coords = np.column_stack([cy, cx])
+coords_tuple = tuple(map(tuple, coords))
 
 # PAGE TABS
 tab1, tab2, tab3, tab4 = st.tabs(["Current", "My Location", "Forecast (24h Avg)", "Historic (Date Range)"])
@@ -73,66 +148,100 @@ def aqi_description(aqi):
         5: "Very Poor"
     }.get(aqi, "Unknown")
 
-def extract_values(aqi_data, pollutant, mode):
-    key = pollutant_key_map(pollutant)
-    if mode == "current":
-        if aqi_data:
-            return aqi_data[0]["components"].get(key)
-    else:
-        vals = [x["components"].get(key) for x in aqi_data if key in x["components"]]
-        vals = [v for v in vals if v is not None]
-        return sum(vals)/len(vals) if vals else None
-    return None
-
-def make_map(aqi_mode, aqi_data_list, title_suffix):
-    neighborhoods["aq_data"] = aqi_data_list
-    neighborhoods["color_val"] = neighborhoods["aq_data"].apply(lambda x: extract_values(x, color_by, aqi_mode))
-    valid_vals = neighborhoods["color_val"].dropna()
-    vmin, vmax = (valid_vals.min(), valid_vals.max()) if not valid_vals.empty else (0, 1)
-    colormap = cm.LinearColormap(["green", "yellow", "red"], vmin=vmin, vmax=vmax, caption=f"{color_by.upper()} ({title_suffix})")
+# Average every selected pollutant for every neighborhood in one pass,
+# so coloring and tooltips share the same (N, pollutants) matrix
+def pollutant_matrix(aqi_data_list, pollutants_used, mode):
+    keys = [pollutant_key_map(p) for p in pollutants_used]
+    avgs = np.full((len(aqi_data_list), len(keys)), np.nan)
+    for i, entries in enumerate(aqi_data_list):
+        if not entries:
+            continue
+        if mode == "current":
+            comp = entries[0]["components"]
+            avgs[i] = [comp.get(k, np.nan) for k in keys]
+        else:
+            rows = np.array([[e["components"].get(k, np.nan) for k in keys] for e in entries], dtype=float)
+            counts = np.sum(~np.isnan(rows), axis=0)
+            avgs[i] = np.where(counts > 0, np.nansum(rows, axis=0) / np.maximum(counts, 1), np.nan)
+    return avgs
+
+# Interpolate the green-yellow-red ramp for all neighborhoods at once
+# rather than calling the branca colormap per polygon
+_RAMP_STOPS = np.array([0.0, 0.5, 1.0])
+_RAMP_RGB = np.array([[0, 128, 0], [255, 255, 0], [255, 0, 0]], dtype=float)
+
+def fill_colors(values, vmin, vmax):
+    missing = np.isnan(values)
+    t = np.clip((np.where(missing, vmin, values) - vmin) / (vmax - vmin + 1e-12), 0, 1)
+    r, g, b = (np.interp(t, _RAMP_STOPS, _RAMP_RGB[:, c]).astype(np.uint8) for c in range(3))
+    colors = np.array([f"#{ri:02x}{gi:02x}{bi:02x}" for ri, gi, bi in zip(r, g, b)], dtype=object)
+    colors[missing] = "gray"
+    return colors
+
+# Cache the fully rendered HTML so reruns from unrelated widget
+# interactions skip both the fetch and the Folium rebuild
+@st.cache_data(ttl=600, max_entries=32)
+def build_map_html(aqi_mode, title_suffix, pollutants_shown, color_key, start_unix=None, end_unix=None):
+    aqi_data_list = load_all_aqi(aqi_mode, start_unix, end_unix, coords_tuple)
+    if aqi_mode == "forecast":
+        aqi_data_list = [entries[:24] for entries in aqi_data_list]
+    avgs = pollutant_matrix(aqi_data_list, pollutants_shown, aqi_mode)
+    color_vals = avgs[:, pollutants_shown.index(color_key)]
+    valid_vals = color_vals[~np.isnan(color_vals)]
+    vmin, vmax = (valid_vals.min(), valid_vals.max()) if valid_vals.size else (0, 1)
+    colormap = cm.LinearColormap(["green", "yellow", "red"], vmin=vmin, vmax=vmax, caption=f"{color_key.upper()} ({title_suffix})")
+    hex_colors = fill_colors(color_vals, vmin, vmax)
     m = folium.Map(location=[41.8781, -87.6298], zoom_start=11, tiles="cartodbpositron")
 
-    for _, row in neighborhoods.iterrows():
-        name = row["neighborhood"]
-        geom = row["geometry"]
-        aq = row["aq_data"]
-        val = row["color_val"]
-        fill = colormap(val) if val is not None else "gray"
-        html = f"<b>{name}</b><br>"
-
-        if aq:
-            if aqi_mode == "current":
-                aqi_index = aq[0]['main']['aqi']
-                html += f"AQI Index: {aqi_index} ({aqi_description(aqi_index)})<br>"
-            for p in selected_pollutants:
-                pval = extract_values(aq, p, aqi_mode)
-                html += f"{p.upper()}: {round(pval, 2) if pval else 'N/A'}<br>"
-        else:
-            html += "No data."
-
-        folium.GeoJson(
-            geom,
-            style_function=lambda _, fill_color=fill: {
-                'fillColor': fill_color,
-                'color': 'black',
-                'weight': 1,
-                'fillOpacity': 0.7
-            },
-            tooltip=folium.Tooltip(html)
-        ).add_to(m)
+    # Plain arrays instead of iterrows(), which boxes a Series per row
+    names = neighborhoods["neighborhood"].to_numpy()
+
+    # One batched GeoJson layer with per-feature properties instead of
+    # N separate layers, each with its own style closure and JS object
+    columns = {"neighborhood": names, "fill_color": hex_colors}
+    tooltip_fields = ["neighborhood"]
+    aliases = ["Neighborhood:"]
+    if aqi_mode == "current":
+        columns["aqi_index"] = [
+            f"{aq[0]['main']['aqi']} ({aqi_description(aq[0]['main']['aqi'])})" if aq else "N/A"
+            for aq in aqi_data_list
+        ]
+        tooltip_fields.append("aqi_index")
+        aliases.append("AQI Index:")
+    for j, p in enumerate(pollutants_shown):
+        columns[p] = ["N/A" if np.isnan(v) else f"{v:.2f}" for v in avgs[:, j]]
+        tooltip_fields.append(p)
+        aliases.append(f"{p.upper()}:")
+
+    layer = gpd.GeoDataFrame(columns, geometry=neighborhoods.geometry, crs=neighborhoods.crs)
+    folium.GeoJson(
+        layer,
+        style_function=lambda f: {
+            'fillColor': f["properties"]["fill_color"],
+            'color': 'black',
+            'weight': 1,
+            'fillOpacity': 0.7
+        },
+        tooltip=folium.GeoJsonTooltip(fields=tooltip_fields, aliases=aliases)
+    ).add_to(m)
 
+    # DivIcon labels are the most expensive marker type, so keep them in a
+    # layer the user toggles on instead of painting hundreds up front
+    labels = folium.FeatureGroup(name="Neighborhood Labels", show=False)
+    for i in range(len(names)):
         folium.map.Marker(
-            [row["centroid"].y, row["centroid"].x],
-            icon=folium.DivIcon(html=f"<div style='font-size:8pt;color:black'>{name}</div>")
-        ).add_to(m)
+            [cy[i], cx[i]],
+            icon=folium.DivIcon(html=f"<div style='font-size:8pt;color:black'>{names[i]}</div>")
+        ).add_to(labels)
+    labels.add_to(m)
+    folium.LayerControl().add_to(m)
 
     colormap.add_to(m)
-    st_folium(m, width=1100, height=750)
+    return m.get_root().render()
 
 with tab1:
     st.subheader("Current AQI")
-    current_data = [fetch_aqi(row["centroid"].y, row["centroid"].x, "current") for _, row in neighborhoods.iterrows()]
-    make_map("current", current_data, "Current")
+    components.html(build_map_html("current", "Current", tuple(selected_pollutants), color_by), height=750)
 
 with tab2:
     st.subheader("My Location")
@@ -142,7 +251,7 @@ with tab2:
         location = geolocator.geocode(address)
         if location:
             lat, lon = location.latitude, location.longitude
-            personal_data = fetch_aqi(lat, lon, "current")
+            personal_data = load_all_aqi("current", None, None, ((lat, lon),))[0]
             m = folium.Map(location=[lat, lon], zoom_start=13, tiles="cartodbpositron")
             if personal_data:
                 comp = personal_data[0]["components"]
@@ -161,8 +270,7 @@ with tab2:
 
 with tab3:
     st.subheader("24-Hour Forecast Average")
-    forecast_data = [fetch_aqi(row["centroid"].y, row["centroid"].x, "forecast")[:24] for _, row in neighborhoods.iterrows()]
-    make_map("forecast", forecast_data, "24h Forecast")
+    components.html(build_map_html("forecast", "24h Forecast", tuple(selected_pollutants), color_by), height=750)
 
 with tab4:
     st.subheader("Historic AQI Average")
@@ -170,5 +278,4 @@ with tab4:
     end_date = st.date_input("End Date", datetime.today(), min_value=start_date, max_value=datetime.today())
     start_ts = int(datetime.combine(start_date, datetime.min.time()).timestamp())
     end_ts = int(datetime.combine(end_date, datetime.min.time()).timestamp())
-    historic_data = [fetch_aqi(row["centroid"].y, row["centroid"].x, "historic", start_ts, end_ts) for _, row in neighborhoods.iterrows()]
-    make_map("historic", historic_data, f"{start_date} to {end_date}")
+    components.html(build_map_html("historic", f"{start_date} to {end_date}", tuple(selected_pollutants), color_by, start_ts, end_ts), height=750)